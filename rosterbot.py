@@ -1,7 +1,10 @@
 #!/usr/bin/env python3
 
 import asyncio
+import bisect
+import collections
 from datetime import datetime, timezone, timedelta
+import functools
 import time
 import os
 import re
@@ -10,10 +13,19 @@ import random  # for testing
 import logging
 import signal
 
-from cachetools.func import ttl_cache
-from icalevents import icalevents
-import redis
+import aiohttp
+from cachetools import TTLCache
+import icalendar
+import recurring_ical_events
+import redis.asyncio as aioredis
 import slack
+from slack.errors import SlackApiError
+
+try:
+  import uvloop
+  uvloop.install()
+except ImportError:
+  pass  # fall back to the default asyncio event loop
 
 
 parser = argparse.ArgumentParser()
@@ -30,24 +42,52 @@ args = parser.parse_args()
 SLACK_TOKEN = args.token
 CALENDAR_URL = os.environ['CALENDAR_URL']
 OHNO_USERS = os.environ['OHNO_USERS'].split(',')
-OHNO_USERS_TEXT = ', '.join(['<@{}>'.format(user) for user in OHNO_USERS])
+OHNO_USERS_TEXT = ', '.join(f'<@{user}>' for user in OHNO_USERS)
 CHANNEL = os.environ['CHANNEL']
 REDIS_ADDRESS = os.environ['REDIS_ADDRESS']
 REDIS_DB = int(os.environ['REDIS_DB'])
+REDIS_MAX_CONNECTIONS = int(os.environ.get('REDIS_MAX_CONNECTIONS', 16))
 START_DATETIME = datetime.fromisoformat(os.environ['START_DATETIME'])
 
 RE_SLACKID = re.compile('<@(\w+)>')
+RE_PAREN_NAME = re.compile(r'\(([^)]*)\)')
+FULLWIDTH_PARENS = str.maketrans({chr(65288): '(', chr(65289): ')'})
 AMENDED_REALNAMETOSLACK_KEY = 'rosterbot:amended_realnametoslack'
+CALENDAR_KEY = 'rosterbot:calendar'
+CALENDAR_TTL_SECONDS = 30            # how long to trust the calendar before revalidating it
+NAME_UPDATES_BATCH = 50          # write amended names to redis once this many are waiting
+NAME_UPDATES_FLUSH_SECONDS = 1   # ... or once the oldest has waited this long
+NAME_UPDATES_MAXSIZE = 1000
+ANNOUNCED_MAXSIZE = 1024
+ANNOUNCED_TTL_SECONDS = 60*60*24  # long after the shift is over
 SLEEP_MINUTES = 1
 CHALLENGE_TIME_OFFSET = 10  # fixed hour offset
 UTCHOURS_ACTIVE_START = (8 - CHALLENGE_TIME_OFFSET) % 24
 UTCHOURS_ACTIVE_END = (21 - CHALLENGE_TIME_OFFSET) % 24
+# bit n set if UTC hour n is active; the modulo handles start being later than end
+ACTIVE_HOURS_MASK = sum(1 << hour for hour in range(24)
+                        if (hour - UTCHOURS_ACTIVE_START) % 24 < (UTCHOURS_ACTIVE_END - UTCHOURS_ACTIVE_START) % 24)
 
 # nb. test value on left, real value on right
 MINUTES_NOUSERS = args.test and 55 or 20  # max is 60, won't be checked before current hour
 MINUTES_NOTIFY = args.test and 120 or 10
 MINUTES_DANGER = args.test and 5 or 1
 
+# how far ahead we need to know about events, and how far ahead we expand them each time
+CALENDAR_LOOKAHEAD = timedelta(minutes=MINUTES_NOTIFY + 60)
+CALENDAR_EXPAND = CALENDAR_LOOKAHEAD + timedelta(hours=4)
+
+# the missing tutors warning and the first shift's notify both happen before the active hours start
+ACTIVE_LEAD = timedelta(minutes=max(MINUTES_NOTIFY, 60))
+INACTIVE_SLEEP_MAX = timedelta(minutes=15)  # so we notice shifts added while we're asleep
+
+USERS_PAGE_LIMIT = 200  # Slack recommends no more than 200 results per page
+SLACK_RETRIES = 3       # attempts per API call before giving up on rate limiting
+SLACK_CONCURRENCY = 8   # messages we'll post at once, to stay within Slack's rate limits
+HTTP_LIMIT_PER_HOST = 64
+HTTP_KEEPALIVE_SECONDS = 300
+HTTP_TIMEOUT_SECONDS = 30  # as the Slack web client uses by default
+
 logger = logging.getLogger('rosterbot')
 
 if args.test:
@@ -56,24 +96,51 @@ if args.test:
 else:
   logging.basicConfig(level=logging.INFO)
   logger.info("rosterbot in PROD MODE")
-logger.info("nouser warning {}min, notify {}min, danger {}min".format(MINUTES_NOUSERS, MINUTES_NOTIFY, MINUTES_DANGER))
+logger.info("nouser warning %dmin, notify %dmin, danger %dmin", MINUTES_NOUSERS, MINUTES_NOTIFY, MINUTES_DANGER)
 
 # connect to things
 sc = slack.WebClient(SLACK_TOKEN, run_async=True)
-r = redis.Redis(host=REDIS_ADDRESS, db=REDIS_DB)
+redis_pool = aioredis.ConnectionPool(host=REDIS_ADDRESS, db=REDIS_DB, max_connections=REDIS_MAX_CONNECTIONS, decode_responses=True)
+r = aioredis.Redis(connection_pool=redis_pool)
+http_session = None  # shared by our HTTP requests for keep-alive; must be created in the event loop
 
 
 def is_checked_hour(hour):
-  if UTCHOURS_ACTIVE_START > UTCHOURS_ACTIVE_END:
-    # start later than end
-    return hour >= UTCHOURS_ACTIVE_START or hour < UTCHOURS_ACTIVE_END
-  # normal contiguous range
-  return hour >= UTCHOURS_ACTIVE_START and hour < UTCHOURS_ACTIVE_END
+  return (ACTIVE_HOURS_MASK >> hour) & 1
+
+
+async def slack_call(method, **kwargs):
+  # retry with exponential backoff if Slack tells us we're being rate limited
+  for attempt in range(SLACK_RETRIES):
+    try:
+      return await method(**kwargs)
+    except SlackApiError as e:
+      if e.response.get('error') != 'ratelimited' or attempt == SLACK_RETRIES - 1:
+        raise
+      # slackclient 2.1 only gives us the response body, later versions include the headers
+      delay = int(getattr(e.response, 'headers', {}).get('Retry-After', 1)) * 2 ** attempt
+      logger.warning('Rate limited by Slack, retrying in %ds', delay)
+      await asyncio.sleep(delay)
+
+
+async def gather_with_concurrency(n, coros):
+  # like asyncio.gather(..., return_exceptions=True), but with at most n running at once
+  semaphore = asyncio.Semaphore(n)
+
+  async def run(coro):
+    async with semaphore:
+      return await coro
+
+  return await asyncio.gather(*[run(coro) for coro in coros], return_exceptions=True)
 
 
 def pretty_time_delta(td):
-  seconds = int(td.total_seconds())
-  seconds = abs(seconds)
+  # cache on whole seconds, since that's all we print
+  return pretty_seconds(abs(int(td.total_seconds())))
+
+
+@functools.lru_cache(maxsize=1024)
+def pretty_seconds(seconds):
   days, seconds = divmod(seconds, 86400)
   hours, seconds = divmod(seconds, 3600)
   minutes, seconds = divmod(seconds, 60)
@@ -87,22 +154,117 @@ def pretty_time_delta(td):
     return '%ds' % (seconds)
 
 
-@ttl_cache(ttl=60*5)
-def get_events():
-  return icalevents.events(url=CALENDAR_URL)
+def to_utc(dt):
+  # all day events are dates and floating times have no timezone; treat both as UTC
+  if not isinstance(dt, datetime):
+    dt = datetime(dt.year, dt.month, dt.day)
+  if dt.tzinfo is None:
+    return dt.replace(tzinfo=timezone.utc)
+  return dt.astimezone(timezone.utc)
 
 
-def get_pending_tutor_cals(now):
-  out = []
-  evs = get_events()
-  #'all_day', 'copy_to', 'description', 'end', 'start', 'summary', 'time_left', 'uid'
-  evs.sort(key=lambda ev: now - ev.start, reverse=True)
+class CalEvent:
+  # a single occurrence of a (possibly recurring) calendar event
+  __slots__ = ('uid', 'summary', 'start', 'end', 'start_ts', 'calid')
 
-  for ev in evs:
-    # is this in the future
-    if (ev.start - now).total_seconds() > 0:
-      out.append(ev)
-  return out
+  def __init__(self, component):
+    self.uid = str(component.get('UID', ''))
+    self.summary = str(component.get('SUMMARY', ''))
+    self.start = to_utc(component['DTSTART'].dt)
+    self.end = to_utc(component['DTEND'].dt) if 'DTEND' in component else self.start
+    self.start_ts = self.start.timestamp()
+    # SO it turns out that Google thinks -1 is a great uid for all events.
+    self.calid = f'{int(self.start_ts)}-{self.summary}'
+
+  def __str__(self):
+    return '{}: {} - {}'.format(self.summary, self.start, self.end)
+
+
+def uniquify_uids(calendar):
+  # Google gives every event the uid -1, and recurring_ical_events takes events sharing a uid
+  # (and a day) to be edits of one another; so give each its own, leaving RECURRENCE-ID
+  # overrides with their master's uid
+  events = [ev for ev in calendar.walk('VEVENT') if 'RECURRENCE-ID' not in ev]
+  counts = collections.Counter(str(ev.get('UID', '')) for ev in events)
+  for (index, ev) in enumerate(events):
+    uid = str(ev.get('UID', ''))
+    if counts[uid] > 1:
+      ev['UID'] = f'{uid}-{index}'
+
+
+calendar_cache = {}       # etag, last_modified and body of the last calendar download
+calendar_ical = None      # icalendar.Calendar parsed from calendar_cache['body']
+calendar_events = None    # CalEvents expanded from calendar_ical, sorted by start
+calendar_starts = []      # start_ts of each of calendar_events, for bisecting
+calendar_expanded = None  # calendar_events covers up until this time
+calendar_checked = None   # monotonic time the calendar was last revalidated
+
+
+async def fetch_calendar():
+  # conditional GET, so an unchanged calendar is a cheap 304 rather than a full download
+  headers = {}
+  if calendar_cache.get('etag'):
+    headers['If-None-Match'] = calendar_cache['etag']
+  if calendar_cache.get('last_modified'):
+    headers['If-Modified-Since'] = calendar_cache['last_modified']
+
+  async with http_session.get(CALENDAR_URL, headers=headers) as response:
+    if response.status == 304:
+      return False
+    response.raise_for_status()
+    body = await response.text()
+
+  calendar_cache['etag'] = response.headers.get('ETag', '')
+  calendar_cache['last_modified'] = response.headers.get('Last-Modified', '')
+  calendar_cache['body'] = body
+
+  # keep it in redis so a restart can revalidate rather than download again
+  try:
+    await r.hset(CALENDAR_KEY, mapping=calendar_cache)
+  except aioredis.RedisError:
+    logger.warning('Failed to save calendar to redis', exc_info=True)
+  return True
+
+
+async def get_events(now):
+  global calendar_ical, calendar_events, calendar_starts, calendar_expanded, calendar_checked
+  checked = time.monotonic()
+  if calendar_checked is None or checked - calendar_checked >= CALENDAR_TTL_SECONDS:
+    if not calendar_cache:
+      try:
+        calendar_cache.update(await r.hgetall(CALENDAR_KEY))
+      except aioredis.RedisError:
+        logger.warning('Failed to load calendar from redis', exc_info=True)
+    try:
+      changed = await fetch_calendar()
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+      if not calendar_cache.get('body'):
+        raise  # nothing to fall back on
+      logger.warning('Failed to fetch calendar, using cached copy', exc_info=True)
+      changed = False
+    if changed or calendar_ical is None:
+      calendar_ical = icalendar.Calendar.from_ical(calendar_cache['body'])
+      uniquify_uids(calendar_ical)
+      calendar_expanded = None
+    calendar_checked = checked
+
+  if calendar_expanded is None or now + CALENDAR_LOOKAHEAD > calendar_expanded:
+    # only expand recurring events over the next few hours, rather than the whole calendar
+    calendar_expanded = now + CALENDAR_EXPAND
+    evs = [CalEvent(ev) for ev in recurring_ical_events.of(calendar_ical).between(now, calendar_expanded)]
+    calendar_events = sorted(evs, key=lambda ev: ev.start)
+    calendar_starts = [ev.start_ts for ev in calendar_events]
+  return calendar_events
+
+
+async def get_pending_tutor_cals(now):
+  evs = await get_events(now)
+
+  # events in the future, up to and including the first that's too far away to notify about
+  now_ts = now.timestamp()
+  i = bisect.bisect_right(calendar_starts, now_ts)
+  j = bisect.bisect_left(calendar_starts, now_ts + MINUTES_NOTIFY * 60, i)
+  return evs[i:j + 1]
 
 
 def event_is_same(ev1, ev2):
@@ -123,19 +285,18 @@ def extract_name_from_cal(next_tutor_cal):
   #next_tutor_cal.summary is something like:  #NCSS Tutoring (Firstname Lastname)
   summary = next_tutor_cal.summary
   # ??? some people have a weird parentheses
-  summary = summary.replace(chr(65288), '(')
-  summary = summary.replace(chr(65289), ')')
-  match = re.search(r'\((.*)\)', summary)
+  summary = summary.translate(FULLWIDTH_PARENS)
+  match = RE_PAREN_NAME.search(summary)
   if not match:
     return None
   name = match[1]
-  logger.info('Name from calendar: {} => {}'.format(s_text(summary), s_name(name)))
+  logger.info('Name from calendar: %s => %s', s_text(summary), s_name(name))
   return(name)
 
 
 async def sendmsg(text, threadid=None, attach=None):
   if args.silent:
-    logger.info('Silent mode, not sending message (threadid={}): {}'.format(threadid, s_text(text)))
+    logger.info('Silent mode, not sending message (threadid=%s): %s', threadid, s_text(text))
     return {'ts': 'TODO-{}'.format(random.random())}
 
   kwargs = {
@@ -146,12 +307,12 @@ async def sendmsg(text, threadid=None, attach=None):
     kwargs['thread_ts'] = threadid
   if attach:
     kwargs['attachments'] = attach
-  response = await sc.chat_postMessage(as_user=True, **kwargs)
+  response = await slack_call(sc.chat_postMessage, as_user=True, **kwargs)
   assert response['ok']
   if threadid:
-    logger.info('Replied to thread {}: {}'.format(threadid, s_text(text)))
+    logger.info('Replied to thread %s: %s', threadid, s_text(text))
   else:
-    logger.info('Messaged channel: {}'.format(s_text(text)))
+    logger.info('Messaged channel: %s', s_text(text))
   return response['message']
 
 
@@ -162,53 +323,155 @@ async def message_tutor(slackid, name, impending_tutor_time):
   elif name:
     text = ":smile: {}'s shift starts in {}, but I don't know their Slack username. Please reply to this thread with an @mention of their username to let me know who they are!".format(name, time_format)
   else:
-    ohno_text = ', '.join(['<@{}>'.format(user) for user in OHNO_USERS])
     text = ":smile: someone's shift starts in {}, but I couldn't find their name in the calendar summary (in brackets, like (Ludwig Kumar)). I'm confused! Pinging {}".format(time_format, OHNO_USERS_TEXT)
   return await sendmsg(text)
 
 
+class Watched:
+  # a message posted about a calendar event, waiting on its tutor to ack
+  __slots__ = ('sourcename', 'calid')
+
+  def __init__(self, sourcename, calid):
+    self.sourcename = sourcename
+    self.calid = calid
+
+
+class Announcement:
+  # a calendar event we've posted about
+  __slots__ = ('cal', 'msgid', 'acked')
+
+  def __init__(self, cal, msgid, acked=False):
+    self.cal = cal
+    self.msgid = msgid
+    self.acked = acked
+
+
 tutors_dict = {}        # real name to slackid
-msg_id_to_watch = {}    # messages posted about calendar events (contains {sourcename, calid})
-already_announced = {}  # calendar events processed and posted about
+slackid_to_name = {}    # slackid to real name, the reverse of tutors_dict
+msg_id_to_watch = TTLCache(ANNOUNCED_MAXSIZE, ANNOUNCED_TTL_SECONDS)    # messages posted about calendar events (Watched)
+already_announced = TTLCache(ANNOUNCED_MAXSIZE, ANNOUNCED_TTL_SECONDS)  # calendar events processed and posted about (Announcement)
 
 
-def format_real_name(real_name):
+tutors_generation = 0   # bumped whenever tutors_dict changes
+
+
+@functools.lru_cache(maxsize=1024)
+def format_real_name_cached(real_name, generation):
   if real_name in tutors_dict:
     slackid = tutors_dict[real_name]
     return '<@{}>'.format(slackid)
   return '{}'.format(real_name)
 
 
+def format_real_name(real_name):
+  return format_real_name_cached(real_name, tutors_generation)
+
+
+def set_tutor(real_name, slackid):
+  global tutors_generation
+  old_slackid = tutors_dict.get(real_name)
+  if old_slackid != slackid and slackid_to_name.get(old_slackid) == real_name:
+    del slackid_to_name[old_slackid]  # this name has moved to a new slackid
+  tutors_dict[real_name] = slackid
+  slackid_to_name[slackid] = real_name
+  tutors_generation += 1
+
+
 def add_tutor(member):
   slackid = member['id']
   real_name = member.get('real_name', member['name'])
   if real_name not in tutors_dict:
-    logger.info('got member: {} => {}'.format(s_name(real_name), slackid))
-    tutors_dict[real_name] = slackid
+    logger.info('got member: %s => %s', s_name(real_name), slackid)
+    set_tutor(real_name, slackid)
 
 
 async def load_tutors_dict():
-  # Woo Thought this was paginated but:
-  # At this time, providing no limit value will result in Slack attempting to deliver you the entire result set. If the collection is too large you may experience HTTP 500 errors. Resolve this scenario by using pagination.
-  response = await sc.users_list()
-  assert response['ok']
+  # providing no limit value means Slack attempts to deliver the entire result set, which
+  # can 500 on large workspaces; so page through, fetching the next page while we process this one
+  fetch = asyncio.create_task(slack_call(sc.users_list, limit=USERS_PAGE_LIMIT))
+  while fetch:
+    response = await fetch
+    assert response['ok']
 
-  for member in response['members']:
-    add_tutor(member)
+    cursor = response.get('response_metadata', {}).get('next_cursor')
+    fetch = None
+    if cursor:
+      fetch = asyncio.create_task(slack_call(sc.users_list, limit=USERS_PAGE_LIMIT, cursor=cursor))
 
-  for (real_name, slackid) in r.hgetall(AMENDED_REALNAMETOSLACK_KEY).items():
-    real_name = real_name.decode('utf-8')
-    slackid = slackid.decode('utf-8')
-    tutors_dict[real_name] = slackid
-    logger.info('loading amended member: {} => {}'.format(s_name(real_name), slackid))
+    for member in response['members']:
+      add_tutor(member)
+
+  for (real_name, slackid) in (await r.hgetall(AMENDED_REALNAMETOSLACK_KEY)).items():
+    set_tutor(real_name, slackid)
+    logger.info('loading amended member: %s => %s', s_name(real_name), slackid)
+
+
+name_updates = None  # queue of (real name, slackid) waiting to be written to redis
+
+
+async def flush_name_updates(pairs):
+  async with r.pipeline(transaction=False) as pipe:
+    for (real_name, slackid) in pairs:
+      pipe.hset(AMENDED_REALNAMETOSLACK_KEY, real_name, slackid)
+    await pipe.execute()
+
+
+async def name_updates_loop():
+  # batch amended names up so they're written in a single round trip
+  loop = asyncio.get_running_loop()
+  pairs = []
+  try:
+    while True:
+      pairs.append(await name_updates.get())
+      deadline = loop.time() + NAME_UPDATES_FLUSH_SECONDS
+      while len(pairs) < NAME_UPDATES_BATCH:
+        try:
+          pairs.append(await asyncio.wait_for(name_updates.get(), deadline - loop.time()))
+        except asyncio.TimeoutError:
+          break
+
+      try:
+        await flush_name_updates(pairs)
+      except aioredis.RedisError:
+        logger.exception('Failed to save %d amended members', len(pairs))
+      pairs = []
+  finally:
+    # don't lose anything still waiting when we're cancelled on shutdown
+    while not name_updates.empty():
+      pairs.append(name_updates.get_nowait())
+    if pairs:
+      try:
+        await flush_name_updates(pairs)
+      except aioredis.RedisError:
+        logger.exception('Failed to save %d amended members', len(pairs))
+
+
+background_tasks = set()  # handler work still in flight, so it isn't garbage collected
+
+
+def background_done(task):
+  background_tasks.discard(task)
+  if not task.cancelled() and task.exception():
+    logger.error('Background task failed', exc_info=task.exception())
+
+
+def run_in_background(coro):
+  # let the RTM handler return straight away, rather than waiting on Slack
+  task = asyncio.create_task(coro)
+  background_tasks.add(task)
+  task.add_done_callback(background_done)
+
+
+async def load_member(slackid):
+  response = await slack_call(sc.users_info, user=slackid)
+  assert response['ok']
+  add_tutor(response['user'])
 
 
 @slack.RTMClient.run_on(event='member_joined_channel')
 async def rtm_member_joined_channel(data, **kwargs):
   logger.debug('%s', data)
-  response = await sc.users_info(user=data['user'])
-  assert response['ok']
-  add_tutor(response['user'])
+  run_in_background(load_member(data['user']))
 
 
 @slack.RTMClient.run_on(event='user_change')
@@ -228,18 +491,18 @@ async def rtm_reaction_added(data, **kwargs):
   if not prev_msg:
     return  # some other message
 
-  slackid = tutors_dict.get(prev_msg['sourcename'], '')
+  slackid = tutors_dict.get(prev_msg.sourcename, '')
   if slackid != userid:
     # if we don't know their slackid then they can't ack this :(
-    logger.info("[{}] got reaction from non-target user: {}".format(msgid, event['reaction']))
+    logger.info("[%s] got reaction from non-target user: %s", msgid, event['reaction'])
     return  # not the user we care about
 
   del msg_id_to_watch[msgid]
-  calid = prev_msg['calid']
-  already_announced[calid]['acked'] = True
+  calid = prev_msg.calid
+  already_announced[calid].acked = True
 
-  await sendmsg("Thanks <@{}>! :+1::star-struck:".format(userid), threadid=msgid)
-  logger.info("[{}] slack user {} acked tutoring with: {}".format(msgid, userid, event['reaction']))
+  run_in_background(sendmsg("Thanks <@{}>! :+1::star-struck:".format(userid), threadid=msgid))
+  logger.info("[%s] slack user %s acked tutoring with: %s", msgid, userid, event['reaction'])
 
 
 @slack.RTMClient.run_on(event='message')
@@ -257,15 +520,15 @@ async def rtm_message(data, **kwargs):
 
   out = RE_SLACKID.match(event['text'])
   if not out:
-    logger.info("[{}] got reply to watched thread, ignoring: {}".format(threadid, s_text(event['text'])))
+    logger.info("[%s] got reply to watched thread, ignoring: %s", threadid, s_text(event['text']))
     return  # no userid
   foundid = out.group(1)
-  tutors_dict[data['sourcename']] = foundid
-  r.hset(AMENDED_REALNAMETOSLACK_KEY, data['sourcename'].encode('utf-8'), foundid.encode('utf-8'))
-  logger.info("[{}] connected '{}' to Slack: {}".format(threadid, s_name(data['sourcename']), foundid))
+  set_tutor(data.sourcename, foundid)
+  await name_updates.put((data.sourcename, foundid))
+  logger.info("[%s] connected '%s' to Slack: %s", threadid, s_name(data.sourcename), foundid)
 
   # if reply contains syntax: <@UBWNYRKDX> map to user
-  await sendmsg("Thanks! I've updated {}'s Slack username to be <@{}> -- please ack the original message with an emoji reaction. :+1:".format(data['sourcename'], foundid), threadid=threadid)
+  run_in_background(sendmsg("Thanks! I've updated {}'s Slack username to be <@{}> -- please ack the original message with an emoji reaction. :+1:".format(data.sourcename, foundid), threadid=threadid))
 
 
 checked_hour = None  # the hour checked up to
@@ -273,6 +536,7 @@ checked_hour = None  # the hour checked up to
 async def process_calendar():
   global checked_hour
   now = datetime.now(timezone.utc)  # calendar data is in UTC
+  now_ts = now.timestamp()
 
   if now < START_DATETIME:
     logger.warning('Doing nothing - %s < %s', now, START_DATETIME)
@@ -287,40 +551,44 @@ async def process_calendar():
       notify_missing_tutors = True
     checked_hour = next_check_hour
 
-  pending = get_pending_tutor_cals(now)
-  logger.info("got {} pending cal events at {}".format(len(pending), now))
+  pending = await get_pending_tutor_cals(now)
+  logger.info("got %d pending cal events at %s", len(pending), now)
+  announcements = {}  # calid to (cal, name) for each message_tutor in posts
+  posts = []
   for next_tutor_cal in pending:
     if next_tutor_cal.start.hour == next_check_hour:
       # got an event starting in the next hour
       if notify_missing_tutors:
-        logger.info("got event starting at {}:00, don't need to notify: {}".format(next_check_hour + CHALLENGE_TIME_OFFSET, s_text(str(next_tutor_cal))))
+        logger.info("got event starting at %d:00, don't need to notify: %s", next_check_hour + CHALLENGE_TIME_OFFSET, s_text(next_tutor_cal))
       notify_missing_tutors = False
 
     # don't notify them, not close enoughb
-    in_minutes = (next_tutor_cal.start - now).total_seconds() / 60.0
-    if in_minutes >= MINUTES_NOTIFY:
+    if next_tutor_cal.start_ts - now_ts >= MINUTES_NOTIFY * 60:
       break
 
-    # SO it turns out that Google thinks -1 is a great uid for all events.
-    calid = '{}-{}'.format(next_tutor_cal.start, next_tutor_cal.summary)
-    if calid in already_announced:
+    calid = next_tutor_cal.calid
+    if calid in already_announced or calid in announcements:
       continue  # don't announce a second time
 
     # they start after this time
-    impending_tutor_time = -(now - next_tutor_cal.start)
+    impending_tutor_time = timedelta(seconds=next_tutor_cal.start_ts - now_ts)
 
     # get tutor name and their slackid if possible
     name = extract_name_from_cal(next_tutor_cal)
     slackid = tutors_dict.get(name, None)
 
     # send them a message (slackid/name might be None) and save it for later
-    m = await message_tutor(slackid, name, impending_tutor_time)
-    msg_id_to_watch[m['ts']] = {'sourcename': name, 'calid': calid}
-    already_announced[calid] = {
-      'cal': next_tutor_cal,
-      'msgid': m['ts'],
-      'acked': False,
-    }
+    announcements[calid] = (next_tutor_cal, name)
+    posts.append(message_tutor(slackid, name, impending_tutor_time))
+
+  results = await gather_with_concurrency(SLACK_CONCURRENCY, posts)
+  for ((calid, (next_tutor_cal, name)), m) in zip(announcements.items(), results):
+    if isinstance(m, Exception):
+      # not saved, so we'll try again next time around
+      logger.error('Failed to announce: %s', s_text(calid), exc_info=m)
+      continue
+    msg_id_to_watch[m['ts']] = Watched(name, calid)
+    already_announced[calid] = Announcement(next_tutor_cal, m['ts'])
 
   if notify_missing_tutors:
     # timezones are hard.
@@ -340,48 +608,88 @@ async def process_calendar():
     ]
     await sendmsg("<!here> Warning! There're no tutors rostered on at <!date^{}^{{time}}|{}:00 AEST>! ({})".format(int(rounded_datetime.timestamp()), local_hour, OHNO_USERS_TEXT), attach=attach)
 
-  for calid in list(already_announced.keys()):  # we might modify this during iteration
-    data = already_announced[calid]
-    cal = data['cal']
-    msgid = data['msgid']
-    if cal.end < now:
-      logger.info('[{}] expiring calendar entry, past end time', msgid)
-      del already_announced[calid]
-      if msgid in msg_id_to_watch:
-          del msgid
-      continue
-
-    if data['acked']:
+  dangers = []  # msgid for each danger message in posts
+  posts = []
+  # old entries expire by themselves, so we only walk the live ones
+  already_announced.expire()
+  for data in list(already_announced.values()):
+    cal = data.cal
+    msgid = data.msgid
+    if data.acked:
       continue  # this has already been ack'd by an emoji.
 
     prev_msg = msg_id_to_watch.get(msgid, None)
     if not prev_msg:
       continue  # Time's up, bot alerted Nicky/Josie, we removed msg.
 
-    event_starts = (cal.start - now)
-    minutes_away = event_starts.total_seconds() / 60  # negative if we've gone past no
-    logger.info('[{}] {} shift in: {}'.format(msgid, s_name(prev_msg['sourcename']), pretty_time_delta(event_starts)))
-    if minutes_away > MINUTES_DANGER:
+    seconds_away = cal.start_ts - now_ts  # negative if we've gone past now
+    if logger.isEnabledFor(logging.INFO):
+      logger.info('[%s] %s shift in: %s', msgid, s_name(prev_msg.sourcename), pretty_time_delta(timedelta(seconds=seconds_away)))
+    if seconds_away > MINUTES_DANGER * 60:
+      continue
+
+    who_text = format_real_name(prev_msg.sourcename)
+    dangers.append(msgid)
+    posts.append(sendmsg("Oh no! {} hasn't responded. Pinging {}".format(who_text, OHNO_USERS_TEXT), threadid=msgid))
+
+  results = await gather_with_concurrency(SLACK_CONCURRENCY, posts)
+  for (msgid, m) in zip(dangers, results):
+    if isinstance(m, Exception):
+      logger.error('[%s] Failed to send danger message', msgid, exc_info=m)
       continue
+    msg_id_to_watch.pop(msgid, None)  # they might have acked while we were posting
+
+
+async def seconds_until_needed(now):
+  # outside the active hours we only need to wake up for shifts that are rostered anyway
+  if is_checked_hour(now.hour) or is_checked_hour((now + ACTIVE_LEAD).hour):
+    return 0
+
+  hour = now.replace(minute=0, second=0, microsecond=0)
+  active_start = hour + timedelta(hours=(UTCHOURS_ACTIVE_START - now.hour) % 24)
+  wake_ts = min(active_start - ACTIVE_LEAD, now + INACTIVE_SLEEP_MAX).timestamp()
 
-    who_text = format_real_name(prev_msg['sourcename'])
-    ohno_text = ', '.join(['<@{}>'.format(user) for user in OHNO_USERS])
-    await sendmsg("Oh no! {} hasn't responded. Pinging {}".format(who_text, OHNO_USERS_TEXT), threadid=msgid)
-    del msg_id_to_watch[msgid]
+  # get_events covers well past INACTIVE_SLEEP_MAX, so we can't sleep through a shift we don't know about
+  await get_events(now)
+  now_ts = now.timestamp()
+  i = bisect.bisect_right(calendar_starts, now_ts)
+  if i < len(calendar_starts):
+    wake_ts = min(wake_ts, calendar_starts[i] - MINUTES_NOTIFY * 60)
+  return max(wake_ts - now_ts, 0)
 
 
 async def process_calendar_loop():
   while True:
+    seconds = await seconds_until_needed(datetime.now(timezone.utc))
+    if seconds > 0:
+      logger.info("Outside active hours with no shifts due; sleeping for %ds", seconds)
+      await asyncio.sleep(seconds)
+      continue
+
     await process_calendar()
     logger.info("Finished processing calendar entries; sleeping")
     await asyncio.sleep(SLEEP_MINUTES * 60)
 
 
 async def main():
+  global name_updates, http_session
+  name_updates = asyncio.Queue(NAME_UPDATES_MAXSIZE)
+  connector = aiohttp.TCPConnector(limit_per_host=HTTP_LIMIT_PER_HOST, keepalive_timeout=HTTP_KEEPALIVE_SECONDS)
+  http_session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=HTTP_TIMEOUT_SECONDS))
+  sc.session = http_session  # otherwise the web client opens a new session per call
+
+  try:
+    await run()
+  finally:
+    await http_session.close()
+
+
+async def run():
   await load_tutors_dict()
   rtm = slack.RTMClient(token=SLACK_TOKEN, run_async=True)
   rtmtask = rtm.start()
   caltask = asyncio.create_task(process_calendar_loop())
+  nametask = asyncio.create_task(name_updates_loop())
 
   # Critical to add our own signal handler, because RTMClient tries to catch these
   # but doesn't bother stopping process_calender_loop
@@ -393,7 +701,13 @@ async def main():
   for s in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
     asyncio.get_event_loop().add_signal_handler(s, stop)
 
-  await asyncio.gather(caltask, rtmtask)
+  try:
+    await asyncio.gather(caltask, rtmtask, nametask)
+  finally:
+    # stop the name writer ourselves and wait for its final flush, rather than
+    # leaving asyncio.run to cancel it again part way through
+    nametask.cancel()
+    await asyncio.wait([nametask])
 
 
 if __name__ == "__main__":